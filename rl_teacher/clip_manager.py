@@ -42,15 +42,39 @@ class SynthClipManager(object):
 
     def add(self, new_clip, *, source="", sync=False):
         # Clips are sorted as they're added
-        new_reward = sum(new_clip["original_rewards"])
-        if new_reward in self._ordinal_rewards:
-            index = self._ordinal_rewards.index(new_reward)
+        new_reward = float(np.sum(new_clip["original_rewards"]))
+        # _ordinal_rewards is kept sorted, so membership and position both
+        # come from one O(log n) bisect rather than an O(n) scan.
+        index = bisect.bisect_left(self._ordinal_rewards, new_reward)
+        if index < len(self._ordinal_rewards) and self._ordinal_rewards[index] == new_reward:
             self._sorted_clips[index].append(new_clip)
         else:
-            index = bisect.bisect(self._ordinal_rewards, new_reward)
             self._ordinal_rewards.insert(index, new_reward)
             self._sorted_clips.insert(index, [new_clip])
 
+    def add_batch(self, new_clips, *, source=""):
+        """ Add many clips at once, grouping the batch by reward sum in one
+        pass instead of paying a sorted-insert per clip. """
+        new_clips = list(new_clips)
+        if not new_clips:
+            return
+        reward_lengths = set(len(clip["original_rewards"]) for clip in new_clips)
+        if len(reward_lengths) == 1:
+            # Clips are normally a fixed segment length, so the whole batch
+            # sums in one vectorized call over an (N, T) array.
+            reward_sums = np.stack([clip["original_rewards"] for clip in new_clips]).sum(axis=1)
+        else:
+            reward_sums = np.array([np.sum(clip["original_rewards"]) for clip in new_clips])
+        for new_reward in np.unique(reward_sums):  # np.unique returns sorted values
+            clips = [new_clips[i] for i in np.flatnonzero(reward_sums == new_reward)]
+            new_reward = float(new_reward)
+            index = bisect.bisect_left(self._ordinal_rewards, new_reward)
+            if index < len(self._ordinal_rewards) and self._ordinal_rewards[index] == new_reward:
+                self._sorted_clips[index].extend(clips)
+            else:
+                self._ordinal_rewards.insert(index, new_reward)
+                self._sorted_clips.insert(index, clips)
+
     @property
     def total_number_of_clips(self):
         return self.number_of_sorted_clips
@@ -178,6 +202,12 @@ class ClipManager(object):
         # Avoid memory leaks!
         self._check_pending_uploads()
 
+    def add_batch(self, new_clips, *, source=""):
+        """ Add many clips. Accepts a lazy iterable, so rendering and uploads
+        can overlap with a clip source that is still producing. """
+        for clip in new_clips:
+            self.add(clip, source=source)
+
     def _check_pending_uploads(self):
         # Check old pending results to see if we can clear memory and add them to the database. Also reveals errors.
         for pending_result in self._pending_upload_results:
@@ -11,29 +11,49 @@ class FullyConnectedMLP(object):
 
     def __init__(self, obs_shape, act_shape, h_size=64):
         # Import Keras here to avoid messing with multiprocessing context too early
-        from keras.layers import Dense, Dropout, LeakyReLU
+        from keras.layers import Dense, Dropout
         from keras.models import Sequential
 
         input_dim = np.prod(obs_shape) + np.prod(act_shape)
 
+        def leaky_relu(x):
+            # Same slope as the keras.layers.LeakyReLU default
+            return tf.nn.leaky_relu(x, alpha=0.3)
+
+        # Fold the activation into the Dense layers so each one emits a
+        # MatMul->BiasAdd->LeakyRelu chain that grappler's remapper can fuse
+        # into a single _FusedMatMul kernel, instead of a standalone
+        # activation op between layers.
         self.model = Sequential()
-        self.model.add(Dense(int(h_size), input_dim=int(input_dim)))
-        self.model.add(LeakyReLU())
+        self.model.add(Dense(int(h_size), input_dim=int(input_dim), activation=leaky_relu))
 
         self.model.add(Dropout(0.5))
-        self.model.add(Dense(h_size))
-        self.model.add(LeakyReLU())
+        self.model.add(Dense(h_size, activation=leaky_relu))
 
         self.model.add(Dropout(0.5))
         self.model.add(Dense(1))
 
-    def run(self, obs, act):
-        #print(obs)
-        #print(act)
-        #flat_obs = keras.layers.Flatten(obs)
-        flat_obs = tf.contrib.layers.flatten(obs)
-        x = tf.concat([flat_obs, act], axis=1)
-        return self.model(x)
+    def run(self, obs, act, training=False):
+        def forward():
+            # Static reshape rather than tf.contrib.layers.flatten: contrib is
+            # gone in TF2, and the hard-coded inner dimension keeps the shape
+            # fully known to grappler/XLA.
+            flat_obs = tf.reshape(obs, [-1, int(np.prod(obs.shape.as_list()[1:]))])
+            x = tf.concat([flat_obs, act], axis=1)
+            # With training=False the dropout layers become identities at graph
+            # construction time, so inference never builds the mask ops at all.
+            return self.model(x, training=training)
+
+        if training:
+            # Let XLA fuse the chain of small pointwise ops (flatten, concat,
+            # Dense+bias+LeakyReLU) into a few kernels instead of one launch
+            # per op. Only the training path is force-compiled: its batch
+            # shape is fixed across each train() call, whereas reward queries
+            # arrive with per-episode lengths and would recompile per shape
+            # on the rollout critical path.
+            with tf.xla.experimental.jit_scope(compile_ops=True):
+                return forward()
+        return forward()
 
 class SimpleConvolveObservationQNet(FullyConnectedMLP):
     """
@@ -47,12 +67,35 @@ class SimpleConvolveObservationQNet(FullyConnectedMLP):
             int(ceil(ceil(obs_shape[1] / 4) / 3)),
             8)
         super().__init__(after_convolve_shape, act_shape, h_size)
+        # Instantiate the conv layers once, like the Sequential above, so
+        # every input run() sees is convolved with the same weights.
+        # Parameters taken from GA3C NetworkVP
+        self._conv1 = tf.layers.Conv2D(4, kernel_size=8, strides=4, padding="same", activation=tf.nn.relu)
+        self._conv2 = tf.layers.Conv2D(8, kernel_size=6, strides=3, padding="same", activation=tf.nn.relu)
+        self._conv_feature_cache = {}  # Maps input tensors to their conv feature tensors
 
-    def run(self, obs, act):
+    def _conv_features(self, obs, training=False):
+        """ Build the conv feature tensor for obs, reusing the already-built
+        subgraph when run() is called again on the same input tensor, so the
+        conv features (the dominant FLOPs) aren't recomputed per call. """
+        cache_key = (obs, training)
+        if cache_key in self._conv_feature_cache:
+            return self._conv_feature_cache[cache_key]
         if len(obs.shape) == 3:
             # Need to add channels
             obs = tf.expand_dims(obs, axis=-1)
-        # Parameters taken from GA3C NetworkVP
-        c1 = tf.layers.conv2d(obs, 4, kernel_size=8, strides=4, padding="same", activation=tf.nn.relu)
-        c2 = tf.layers.conv2d(c1, 8, kernel_size=6, strides=3, padding="same", activation=tf.nn.relu)
-        return super().run(c2, act)
+        if training:
+            # Both convs (with bias+relu folded into the conv epilogue) live in
+            # one XLA cluster so the chain compiles as a single fused unit, and
+            # its gradients get their own cluster instead of bloating the
+            # forward one. As in the MLP, only the fixed-shape training path
+            # is force-compiled.
+            with tf.xla.experimental.jit_scope(compile_ops=True, separate_compiled_gradients=True):
+                c2 = self._conv2(self._conv1(obs))
+        else:
+            c2 = self._conv2(self._conv1(obs))
+        self._conv_feature_cache[cache_key] = c2
+        return c2
+
+    def run(self, obs, act, training=False):
+        return super().run(self._conv_features(obs, training=training), act, training=training)
@@ -7,22 +7,23 @@ from multiprocessing import Process
 import numpy as np
 import tensorflow.compat.v1 as tf
 tf.disable_v2_behavior()
+from tensorflow.core.protobuf import rewriter_config_pb2
 
-from keras import backend as K
 from scipy import stats
 
 from rl_teacher.clip_manager import SynthClipManager, ClipManager
 from rl_teacher.nn import FullyConnectedMLP, SimpleConvolveObservationQNet
-from rl_teacher.segment_sampling import segments_from_rand_rollout, sample_segment_from_path, basic_segment_from_null_action
+from rl_teacher.segment_sampling import stream_segments_from_rand_rollout, sample_segment_from_path, basic_segment_from_null_action
 from rl_teacher.utils import corrcoef
 
-def nn_predict_rewards(obs_segments, act_segments, network, obs_shape, act_shape):
+def nn_predict_rewards(obs_segments, act_segments, network, obs_shape, act_shape, training=False):
     """
     :param obs_segments: tensor with shape = (batch_size, segment_length) + obs_shape
     :param act_segments: tensor with shape = (batch_size, segment_length) + act_shape
     :param network: neural net with .run() that maps obs and act tensors into a (scalar) value tensor
     :param obs_shape: a tuple representing the shape of the observation space
     :param act_shape: a tuple representing the shape of the action space
+    :param training: whether to build the network's training path (e.g. active dropout)
     :return: tensor with shape = (batch_size, segment_length)
     """
     batchsize = tf.shape(obs_segments)[0]
@@ -33,7 +34,7 @@ def nn_predict_rewards(obs_segments, act_segments, network, obs_shape, act_shape
     acts = tf.reshape(act_segments, (-1,) + act_shape)
 
     # Run them through our neural network
-    rewards = network.run(obs, acts)
+    rewards = network.run(obs, acts, training=training)
 
     # Group the rewards back into their segments
     return tf.reshape(rewards, (batchsize, segment_length))
@@ -103,8 +104,27 @@ class OrdinalRewardModel(RewardModel):
             # log_device_placement=True,
         )
         config.gpu_options.per_process_gpu_memory_fraction = 0.35  # allow_growth = True
+        # Pin grappler's fusion passes on rather than trusting build defaults:
+        # remapping collapses the MatMul/Conv+BiasAdd+activation chains our
+        # graph is shaped for, and these fire even where the (GPU-only) XLA
+        # JIT below does not.
+        config.graph_options.rewrite_options.remapping = rewriter_config_pb2.RewriterConfig.ON
+        config.graph_options.rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.ON
+        config.graph_options.rewrite_options.constant_folding = rewriter_config_pb2.RewriterConfig.ON
+        if tf.config.list_physical_devices('GPU'):
+            # Session-level XLA JIT amortizes kernel launches across the many
+            # tiny ops in our graph. It only applies to GPU-placed ops.
+            # (list_physical_devices just enumerates; probing with
+            # tf.test.is_gpu_available would initialize the GPUs with default
+            # options and lock in an allocator that grabs all their memory
+            # before this config is ever applied.)
+            config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
         self.sess = tf.compat.v1.Session(config=config)
 
+        # Rollout-time reward queries are served from a frozen (constants-only)
+        # copy of the inference path, rebuilt whenever the weights change.
+        self._frozen_sess = None
+
         self.obs_shape = env.observation_space.shape
         if stacked_frames > 0:
             self.obs_shape = self.obs_shape + (stacked_frames,)
@@ -124,41 +144,90 @@ class OrdinalRewardModel(RewardModel):
         # Set up action placeholder
         if self.discrete_action_space:
             self.act_placeholder = tf.placeholder(dtype=tf.float32, shape=(None, None), name="act_placeholder")
-            # Discrete actions need to become one-hot vectors for the model
-            segment_act = tf.one_hot(tf.cast(self.act_placeholder, tf.int32), self.act_shape[0])
             # HACK Use a convolutional network for Atari
             # TODO Should check the input space dimensions, not the output space!
             net = SimpleConvolveObservationQNet(self.obs_shape, self.act_shape)
         else:
             self.act_placeholder = tf.placeholder(dtype=tf.float32, shape=(None, None) + self.act_shape, name="act_placeholder")
-            # Assume the actions are how we want them
-            segment_act = self.act_placeholder
             # In simple environments, default to a basic Multi-layer Perceptron (see TODO above)
             net = FullyConnectedMLP(self.obs_shape, self.act_shape)
 
-        # Our neural network maps a (state, action) pair to a reward
-        self.rewards = nn_predict_rewards(self.obs_placeholder, segment_act, net, self.obs_shape, self.act_shape)
+        def segment_act_for(act_tensor):
+            if self.discrete_action_space:
+                # Discrete actions need to become one-hot vectors for the model
+                return tf.one_hot(tf.cast(act_tensor, tf.int32), self.act_shape[0])
+            # Assume the actions are how we want them
+            return act_tensor
+
+        self.targets = tf.placeholder(dtype=tf.float32, shape=(None,), name="reward_targets")
+
+        # Training inputs flow through a tf.data pipeline rather than per-step
+        # feed_dict copies: the batch is uploaded once per train() call when
+        # the iterator is initialized, then stays in place across iterations.
+        dataset = tf.data.Dataset.from_tensors(
+            (self.obs_placeholder, self.act_placeholder, self.targets)).repeat().prefetch(1)
+        self._train_iterator = tf.data.make_initializable_iterator(dataset)
+        train_obs, train_act, train_targets = self._train_iterator.get_next()
+
+        # Our neural network maps a (state, action) pair to a reward.
+        # The inference path is built with dropout statically disabled, so
+        # reward queries during rollout never pay for the mask ops.
+        self.rewards = nn_predict_rewards(
+            self.obs_placeholder, segment_act_for(self.act_placeholder), net,
+            self.obs_shape, self.act_shape, training=False)
+
+        # Weight-sharing training path (dropout active), fed from the iterator
+        training_rewards = nn_predict_rewards(
+            train_obs, segment_act_for(train_act), net, self.obs_shape, self.act_shape, training=True)
 
         # We use trajectory segments rather than individual (state, action) pairs because
         # video clips of segments are easier for humans to evaluate
-        self.segment_rewards = tf.reduce_sum(self.rewards, axis=1)
-
-        self.targets = tf.placeholder(dtype=tf.float32, shape=(None,), name="reward_targets")
+        self.segment_rewards = tf.reduce_sum(training_rewards, axis=1)
 
-        self.loss = tf.reduce_mean(tf.square(self.targets - self.segment_rewards))
+        self.loss = tf.reduce_mean(tf.square(train_targets - self.segment_rewards))
 
         self.train_op = tf.train.AdamOptimizer().minimize(self.loss)
 
         return tf.get_default_graph()
 
+    def _refresh_frozen_predictor(self):
+        """ Re-freeze the inference path into a constants-only graph.
+        The frozen copy has no variable reads and none of the training ops,
+        so per-query overhead on the rollout path is minimal. """
+        with self.graph.as_default():
+            frozen_graph_def = tf.graph_util.convert_variables_to_constants(
+                self.sess, self.graph.as_graph_def(), [self.rewards.op.name])
+        frozen_graph = tf.Graph()
+        with frozen_graph.as_default():
+            tf.import_graph_def(frozen_graph_def, name="")
+        if self._frozen_sess:
+            self._frozen_sess.close()
+        # The serving session gets its own lightweight config: grow memory as
+        # needed instead of cloning the training session's standing GPU
+        # reservation, which would double what the reward model holds and
+        # starve the agent graphs. The grappler fusion passes stay pinned on.
+        frozen_config = tf.compat.v1.ConfigProto()
+        frozen_config.gpu_options.allow_growth = True
+        frozen_config.graph_options.rewrite_options.remapping = rewriter_config_pb2.RewriterConfig.ON
+        frozen_config.graph_options.rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.ON
+        frozen_config.graph_options.rewrite_options.constant_folding = rewriter_config_pb2.RewriterConfig.ON
+        self._frozen_sess = tf.compat.v1.Session(graph=frozen_graph, config=frozen_config)
+        self._frozen_obs_placeholder = frozen_graph.get_tensor_by_name(self.obs_placeholder.name)
+        self._frozen_act_placeholder = frozen_graph.get_tensor_by_name(self.act_placeholder.name)
+        self._frozen_rewards = frozen_graph.get_tensor_by_name(self.rewards.name)
+        # Warm the fresh session right away: each refresh discards the previous
+        # session's compiled state, so without this the next reward query
+        # would pay the graph-optimization/JIT stall mid-rollout.
+        self._warm_up()
+
     def predict_reward(self, path):
         """Predict the reward for each step in a given path"""
-        with self.graph.as_default():
-            predicted_rewards = self.sess.run(self.rewards, feed_dict={
-                self.obs_placeholder: np.asarray([path["obs"]]),
-                self.act_placeholder: np.asarray([path["actions"]]),
-                K.learning_phase(): False
-            })
+        if self._frozen_sess is None:
+            self._refresh_frozen_predictor()
+        predicted_rewards = self._frozen_sess.run(self._frozen_rewards, feed_dict={
+            self._frozen_obs_placeholder: np.asarray([path["obs"]]),
+            self._frozen_act_placeholder: np.asarray([path["actions"]]),
+        })
         return predicted_rewards[0]  # The zero here is to get the single returned path.
 
     def path_callback(self, path):
@@ -191,20 +260,22 @@ class OrdinalRewardModel(RewardModel):
 
         desired_clips = n_pretrain_clips - self.clip_manager.total_number_of_clips
 
-        random_clips = segments_from_rand_rollout(
-            env_id, make_env, n_desired_segments=desired_clips,
-            clip_length_in_seconds=clip_length, stacked_frames=stacked_frames, workers=workers)
-
-        for clip in random_clips:
-            self.clip_manager.add(clip, source="random rollout")
+        # Hand the clip manager the (lazy) stream of rollout segments, so it
+        # can either bulk-insert them or overlap uploads with the rollouts
+        # still in flight, as appropriate.
+        self.clip_manager.add_batch(
+            stream_segments_from_rand_rollout(
+                env_id, make_env, n_desired_segments=desired_clips,
+                clip_length_in_seconds=clip_length, stacked_frames=stacked_frames, workers=workers),
+            source="random rollout")
 
     def calculate_targets(self, ordinals):
         """ Project ordinal information into a cardinal value to use as a reward target """
         max_ordinal = self.clip_manager.maximum_ordinal  # Equivalent to the size of the sorting tree
         step_size = 1.0 / (max_ordinal + 1)
         offset = step_size / 2
-        targets = [self._standard_deviation * stats.norm.ppf(offset + (step_size * o)) for o in ordinals]
-        return targets
+        # One vectorized ppf call over every ordinal instead of one per label
+        return self._standard_deviation * stats.norm.ppf(offset + step_size * np.asarray(ordinals))
 
     def train(self, iterations=1, report_frequency=None):
         self.clip_manager.sort_clips()
@@ -216,19 +287,51 @@ class OrdinalRewardModel(RewardModel):
         targets = self.calculate_targets(ordinals)
 
         with self.graph.as_default():
+            # The batch doesn't change between iterations, so upload it once
+            # by initializing the training iterator; the step loop below then
+            # runs without any per-step feed_dict copies.
+            self.sess.run(self._train_iterator.initializer, feed_dict={
+                self.obs_placeholder: np.asarray(obs),
+                self.act_placeholder: np.asarray(acts),
+                self.targets: np.asarray(targets),
+            })
             for i in range(1, iterations + 1):
-                _, loss = self.sess.run([self.train_op, self.loss], feed_dict={
-                    self.obs_placeholder: np.asarray(obs),
-                    self.act_placeholder: np.asarray(acts),
-                    self.targets: np.asarray(targets),
-                    K.learning_phase(): True
-                })
+                will_report = (report_frequency and i % report_frequency == 0) or iterations == 1
+                if will_report:
+                    _, loss = self.sess.run([self.train_op, self.loss])
+                else:
+                    # Only fetch the loss when we're going to print it.
+                    # Fetching it every step forces a device-to-host copy per iteration.
+                    self.sess.run(self.train_op)
                 self._elapsed_training_iters += 1
                 if report_frequency and i % report_frequency == 0:
                     print("%s/%s reward model training iters. (Err: %s)" % (i, iterations, loss))
                 elif iterations == 1:
                     print("Reward model training iter %s (Err: %s)" % (self._elapsed_training_iters, loss))
 
+        # The weights just changed, so rebuild the frozen serving copy.
+        self._refresh_frozen_predictor()
+
+    def _warm_up(self, batch_size=1, segment_length=None):
+        """ Run a throwaway prediction through the frozen serving copy so its
+        one-time costs (grappler passes, allocator setup) are paid now rather
+        than on the first real reward query. The serving graph carries no
+        forced-XLA attributes, so warming a single shape is enough even
+        though real queries arrive with per-episode lengths. """
+        if self._frozen_sess is None:
+            self._refresh_frozen_predictor()
+        if segment_length is None:
+            segment_length = max(1, int(self._frames_per_segment))
+        obs = np.zeros((batch_size, segment_length) + self.obs_shape, dtype=np.float32)
+        if self.discrete_action_space:
+            acts = np.zeros((batch_size, segment_length), dtype=np.float32)
+        else:
+            acts = np.zeros((batch_size, segment_length) + self.act_shape, dtype=np.float32)
+        self._frozen_sess.run(self._frozen_rewards, feed_dict={
+            self._frozen_obs_placeholder: obs,
+            self._frozen_act_placeholder: acts,
+        })
+
     def _checkpoint_filename(self):
         return 'checkpoints/reward_model/%s/treesave' % (self.experiment_name)
 
@@ -243,6 +346,7 @@ class OrdinalRewardModel(RewardModel):
         else:
             self.saver.restore(self.sess, filename)
             print("Reward model loaded from checkpoint!")
+            self._refresh_frozen_predictor()
             # Dump model outputs with errors
             if True:  # <-- Toggle testing with this
                 with self.graph.as_default():
@@ -252,7 +356,6 @@ class OrdinalRewardModel(RewardModel):
                         predicted_rewards = self.sess.run(self.rewards, feed_dict={
                             self.obs_placeholder: np.asarray([clips[i]["obs"]]),
                             self.act_placeholder: np.asarray([clips[i]["actions"]]),
-                            K.learning_phase(): False
                         })[0]
                         reward_sum = sum(predicted_rewards)
                         starting_reward = predicted_rewards[0]
@@ -24,6 +24,18 @@ def sample_segment_from_path(path, segment_length):
 
     return segment
 
+def sample_segments_from_path(path, segment_length, n_samples):
+    """ Returns a list of n_samples segments from random places in a path,
+    drawing all the start positions in a single call rather than one at a
+    time. Returns an empty list if the path is too short. """
+    path_length = len(path["obs"])
+    if path_length < segment_length:
+        return []
+
+    start_positions = np.random.randint(0, path_length - segment_length + 1, size=n_samples)
+
+    return [_slice_path(path, segment_length, start_pos) for start_pos in start_positions]
+
 def offset_for_stacking(items, offset):
     """ Remove offset items from the end and copy out items from the start
     of the list to offset to the original length. """
@@ -102,10 +114,8 @@ def basic_segments_from_rand_rollout(
         # Calculate the number of segments to sample from the path
         # Such that the probability of sampling the same part twice is fairly low.
         segments_for_this_path = max(1, int(0.25 * len(path["obs"]) / segment_length))
-        for _ in range(segments_for_this_path):
-            segment = sample_segment_from_path(path, segment_length)
-            if segment:
-                segments.append(segment)
+        for segment in sample_segments_from_path(path, segment_length, segments_for_this_path):
+            segments.append(segment)
 
             if _verbose and len(segments) % 10 == 0 and len(segments) > 0:
                 print("Collected %s/%s segments" % (len(segments) * _multiplier, n_desired_segments * _multiplier))
@@ -114,17 +124,39 @@ def basic_segments_from_rand_rollout(
         print("Successfully collected %s segments" % (len(segments) * _multiplier))
     return segments
 
-def segments_from_rand_rollout(env_id, make_env, n_desired_segments, clip_length_in_seconds, stacked_frames, workers):
-    """ Generate a list of path segments by doing random rollouts. Can use multiple processes. """
+def stream_segments_from_rand_rollout(env_id, make_env, n_desired_segments, clip_length_in_seconds, stacked_frames, workers):
+    """ Yield path segments from random rollouts as worker processes finish them.
+    Lets the caller overlap per-segment work (pickling, video encoding, uploads)
+    with the rollouts that are still running, instead of waiting for the full batch. """
     if workers < 2:  # Default to basic segment collection
-        return basic_segments_from_rand_rollout(env_id, make_env, n_desired_segments, clip_length_in_seconds, stacked_frames)
+        yield from basic_segments_from_rand_rollout(env_id, make_env, n_desired_segments, clip_length_in_seconds, stacked_frames)
+        return
 
     pool = Pool(processes=workers)
     segments_per_worker = int(math.ceil(n_desired_segments / workers))
     # One job per worker. Only the first worker is verbose.
-    jobs = [
-        (env_id, make_env, segments_per_worker, clip_length_in_seconds, stacked_frames, i, i == 0, workers)
+    pending = [
+        pool.apply_async(basic_segments_from_rand_rollout, (
+            env_id, make_env, segments_per_worker, clip_length_in_seconds, stacked_frames, i, i == 0, workers))
         for i in range(workers)]
-    results = pool.starmap(basic_segments_from_rand_rollout, jobs)
     pool.close()
-    return [segment for sublist in results for segment in sublist][:n_desired_segments]
+    n_yielded = 0
+    while pending and n_yielded < n_desired_segments:
+        still_pending = []
+        for job in pending:
+            if job.ready():
+                for segment in job.get():
+                    if n_yielded < n_desired_segments:
+                        yield segment
+                        n_yielded += 1
+            else:
+                still_pending.append(job)
+        pending = still_pending
+        if pending:
+            pending[0].wait(0.1)
+    pool.join()
+
+def segments_from_rand_rollout(env_id, make_env, n_desired_segments, clip_length_in_seconds, stacked_frames, workers):
+    """ Generate a list of path segments by doing random rollouts. Can use multiple processes. """
+    return list(stream_segments_from_rand_rollout(
+        env_id, make_env, n_desired_segments, clip_length_in_seconds, stacked_frames, workers))